@@ -1,11 +1,20 @@
 import os
-import glob
+from collections import Counter
+import functools
+import hashlib
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from datetime import datetime, timezone
+import numpy as np
 import pandas as pd
-from pymongo import MongoClient
-from pymongo.errors import ConnectionFailure, OperationFailure, ServerSelectionTimeoutError
-from datetime import datetime
-from decimal import Decimal, InvalidOperation
+import pyarrow as pa
+import pyarrow.compute as pc
+from pyarrow import csv as pacsv
+from pymongo import IndexModel, MongoClient, UpdateOne
+from pymongo.errors import ConnectionFailure, DuplicateKeyError, OperationFailure, ServerSelectionTimeoutError
+from decimal import Decimal
 from bson.decimal128 import Decimal128
+from bson.objectid import ObjectId
 import logging
 from dotenv import load_dotenv
 import time # Import time for sleep
@@ -24,8 +33,15 @@ MONGO_HOST = os.getenv('MONGO_HOST', 'mongodb')
 MONGO_PORT = int(os.getenv('MONGO_PORT', 27017))
 MONGO_DB_NAME = os.getenv('MONGO_DB_NAME')
 MONGO_COLLECTION_NAME = os.getenv('MONGO_COLLECTION_NAME')
+MONGO_MAX_POOL_SIZE = int(os.getenv('MONGO_MAX_POOL_SIZE', 200))
+MONGO_COMPRESSORS = os.getenv('MONGO_COMPRESSORS', 'zstd,zlib') # Negotiated with the server in this order
+# Loads are idempotent (deterministic _ids), so by default writes are not waited on for the journal.
+MONGO_WRITE_JOURNAL = os.getenv('MONGO_WRITE_JOURNAL', 'false').lower() == 'true'
 DATA_DIR = "/usr/src/app/data"
-PROCESSED_FILES_LOG = "/usr/src/app/data/processed_files.log"
+ETL_STATE_COLLECTION_NAME = "_etl_state" # One document per processed file, keyed by filename
+LEGACY_PROCESSED_FILES_LOG = "/usr/src/app/data/processed_files.log" # Imported while the state collection is still empty
+INSERT_BATCH_SIZE = int(os.getenv('ETL_BATCH_SIZE', 5000)) # Documents sent per bulk_write call
+ETL_MAX_WORKERS = int(os.getenv('ETL_MAX_WORKERS', os.cpu_count() or 1)) # Files processed in parallel
 
 # --- Helper Functions ---
 
@@ -37,7 +53,15 @@ def get_mongo_client(max_retries=5, retry_delay=10): # Added retry parameters
         try:
             logging.info(f"Attempting to connect to MongoDB (attempt {attempt + 1}/{max_retries})...")
             # Add serverSelectionTimeoutMS to MongoClient to control how long to wait for server selection
-            client = MongoClient(mongo_uri, serverSelectionTimeoutMS=5000) # 5 second timeout for server selection
+            client = MongoClient(
+                mongo_uri,
+                serverSelectionTimeoutMS=5000, # 5 second timeout for server selection
+                maxPoolSize=MONGO_MAX_POOL_SIZE,
+                compressors=MONGO_COMPRESSORS,
+                retryWrites=True,
+                w=1,
+                journal=MONGO_WRITE_JOURNAL,
+            )
             # The ismaster command is cheap and does not require auth.
             client.admin.command('ismaster') # Check connection
             logging.info(f"Successfully connected to MongoDB at {MONGO_HOST}:{MONGO_PORT}")
@@ -61,101 +85,306 @@ def get_mongo_client(max_retries=5, retry_delay=10): # Added retry parameters
     return None
 
 
-# ... (rest of the helper functions: clean_name, parse_date, to_decimal128, get_processed_files, mark_file_as_processed remain the same) ...
-def clean_name(name_str):
-    """Cleans and standardizes a name string."""
-    if pd.isna(name_str):
-        return None
-    return str(name_str).strip().title()
+def to_decimal128_column(series):
+    """Converts a billing column to a list of Decimal128 values (None where the amount is missing or invalid)."""
+    amounts = pd.to_numeric(series.str.strip(), errors='coerce')
+    # tolist() hands back plain Python floats, whose repr is the shortest string that round-trips.
+    values = amounts.to_numpy(dtype='float64', na_value=float('nan')).tolist()
+    return [Decimal128(Decimal(repr(value))) if value == value else None for value in values]
 
-def parse_date(date_str, date_format="%d/%m/%Y"):
-    """Parses a date string into a datetime object."""
-    if pd.isna(date_str) or date_str == "":
-        return None
-    try:
-        return datetime.strptime(str(date_str).strip(), date_format)
-    except ValueError:
-        logging.warning(f"Could not parse date: {date_str} with format {date_format}. Returning None.")
-        return None
-
-def to_decimal128(value_str):
-    """Converts a string to Decimal128 for MongoDB, handling potential errors."""
-    if pd.isna(value_str):
-        return None
-    try:
-        py_decimal = Decimal(str(value_str).strip())
-        return Decimal128(py_decimal)
-    except InvalidOperation:
-        logging.warning(f"Could not convert billing amount '{value_str}' to Decimal. Returning None.")
-        return None
-    except Exception as e:
-        logging.warning(f"Error converting '{value_str}' to Decimal128: {e}. Returning None.")
-        return None
+# Maps CSV headers to MongoDB field names, together with the text cleaning applied column-wise.
+TEXT_COLUMNS = {
+    'Name': ('name', True),
+    'Gender': ('gender', True),
+    'Blood Type': ('blood_type', False),
+    'Medical Condition': ('medical_condition', True),
+    'Doctor': ('doctor_name', True),
+    'Hospital': ('hospital_name', False),
+    'Insurance Provider': ('insurance_provider', False),
+    'Room Number': ('room_number', False),
+    'Admission Type': ('admission_type', True),
+    'Medication': ('medication', True),
+    'Test Results': ('test_results', True),
+}
+# Columns with a handful of distinct values; these are cleaned once per category instead of once per row.
+LOW_CARDINALITY_COLUMNS = {
+    'Gender', 'Blood Type', 'Medical Condition', 'Insurance Provider', 'Admission Type', 'Medication', 'Test Results',
+}
+DATE_COLUMNS = {
+    'Date of Admission': 'admission_date',
+    'Discharge Date': 'discharge_date',
+}
+DATE_FORMAT = "%d/%m/%Y"
+# Field order of the stored documents.
+RECORD_FIELDS = [
+    'name', 'name_lc', 'age', 'gender', 'blood_type', 'medical_condition', 'admission_date', 'doctor_name',
+    'hospital_name', 'insurance_provider', 'billing_amount', 'room_number', 'admission_type',
+    'discharge_date', 'medication', 'test_results', '_source_filename',
+]
+
+def read_csv_file(filepath):
+    """Parses a CSV file with the multithreaded Arrow reader into an Arrow-backed DataFrame, plus a per-column boolean mask of unparseable dates."""
+    # Text, billing and date columns are kept as strings so Arrow's type inference cannot
+    # turn e.g. room numbers into integers or billing amounts into lossy floats.
+    string_columns = [*TEXT_COLUMNS, *DATE_COLUMNS, 'Billing Amount']
+    # The file is memory-mapped so the kernel pages it in on demand (with readahead) instead
+    # of it being copied through a Python-side read buffer; the map is closed once parsed.
+    with pa.memory_map(filepath, 'r') as source:
+        table = pacsv.read_csv(
+            source,
+            parse_options=pacsv.ParseOptions(delimiter=';'),
+            convert_options=pacsv.ConvertOptions(
+                column_types={column: pa.string() for column in string_columns},
+                strings_can_be_null=True,  # Empty fields are missing values, as with pd.read_csv
+            ),
+        )
+    # Dates are parsed on the Arrow side; unparseable values become null instead of failing the file.
+    unparseable_dates = {}
+    for column in DATE_COLUMNS:
+        index = table.schema.get_field_index(column)
+        if index != -1:
+            parsed = pc.strptime(pc.utf8_trim_whitespace(table[column]), format=DATE_FORMAT, unit='s', error_is_null=True)
+            unparseable_dates[column] = pc.and_(pc.is_null(parsed), pc.is_valid(table[column])).to_numpy()
+            table = table.set_column(index, column, parsed)
+    return table.to_pandas(types_mapper=pd.ArrowDtype), unparseable_dates
+
+def clean_text_column(series, title_case=False):
+    """Strips (and optionally title-cases) a whole text column, keeping missing values missing."""
+    cleaned = series.str.strip()
+    if title_case:
+        cleaned = cleaned.str.title()
+    return cleaned
+
+def clean_category_column(series, title_case=False):
+    """Like clean_text_column, but only the distinct values are cleaned and then mapped back onto the rows."""
+    categorical = series.astype('category')
+    categories = categorical.cat.categories
+    cleaned = clean_text_column(categories.to_series(index=categories), title_case)
+    # map() rather than rename_categories(): two raw values may clean to the same string.
+    return categorical.map(cleaned.to_dict())
 
-def get_processed_files():
-    """Reads the list of already processed files."""
-    if not os.path.exists(PROCESSED_FILES_LOG):
-        return set()
-    with open(PROCESSED_FILES_LOG, 'r') as f:
-        return set(line.strip() for line in f)
+@functools.lru_cache(maxsize=None)
+def get_record_builder(fields):
+    """Returns a function turning a positional row tuple into a record dict, generated once per field layout."""
+    # The generated function is a single dict literal indexing the tuple by position, so building
+    # a record costs no per-field lookups, zip() or value boxing.
+    items = ', '.join(f"{field!r}: row[{position}]" for position, field in enumerate(fields))
+    namespace = {}
+    exec(compile(f"def build_record(row):\n    return {{{items}}}\n", '<record_builder>', 'exec'), namespace)
+    return namespace['build_record']
 
-def mark_file_as_processed(filename):
-    """Adds a filename to the list of processed files."""
-    with open(PROCESSED_FILES_LOG, 'a') as f:
-        f.write(filename + '\n')
+def backfill_name_lc(db_collection):
+    """Sets name_lc on records loaded before it existed (their files are never re-ingested)."""
+    # Lowercased here with str.lower(), like new rows, rather than with the server's $toLower,
+    # which only handles ASCII and would disagree with freshly loaded non-ASCII names.
+    cursor = db_collection.find({'name_lc': {'$exists': False}, 'name': {'$type': 'string'}}, {'name': 1})
+    backfilled_count = 0
+    requests = []
+    for doc in cursor:
+        requests.append(UpdateOne({'_id': doc['_id']}, {'$set': {'name_lc': doc['name'].lower()}}))
+        if len(requests) == INSERT_BATCH_SIZE:
+            backfilled_count += db_collection.bulk_write(requests, ordered=False).modified_count
+            requests = []
+    if requests:
+        backfilled_count += db_collection.bulk_write(requests, ordered=False).modified_count
+    if backfilled_count:
+        logging.info(f"Backfilled name_lc on {backfilled_count} existing records in {db_collection.name}.")
+
+def ensure_indexes(db_collection):
+    """Creates the indexes used by the example queries (a no-op for indexes that already exist)."""
+    index_names = db_collection.create_indexes([
+        IndexModel([('admission_date', 1)]),
+        IndexModel([('age', 1)]),
+        IndexModel([('medication', 1)]),
+        IndexModel([('medical_condition', 1)]),
+        IndexModel([('name_lc', 1)]),
+    ])
+    logging.info(f"Ensured indexes on {db_collection.name}: {', '.join(index_names)}")
+
+def record_id(source_filename, row_number):
+    """Derives a deterministic ObjectId from a record's source file and its row number in that file."""
+    # Patient fields are not unique (the same name can be admitted twice on one day), so the
+    # key is the row's position in its file, which is unique and stable across re-runs.
+    row_key = f"{source_filename}|{row_number}"
+    return ObjectId(hashlib.blake2b(row_key.encode('utf-8'), digest_size=12).digest())
+
+def import_legacy_processed_files(state_collection):
+    """Copies filenames from the old processed_files.log into the state collection, if that is still empty."""
+    # The log is left in place (it is tracked in git and may sit on a read-only mount), so it is
+    # only imported before the state collection has any entries. Later runs skip the read, and
+    # deleting a file's state document still forces that file to be re-ingested.
+    if not os.path.exists(LEGACY_PROCESSED_FILES_LOG) or state_collection.find_one({}, {'_id': 1}) is not None:
+        return
+    with open(LEGACY_PROCESSED_FILES_LOG, 'r') as f:
+        filenames = {line.strip() for line in f if line.strip()}
+    imported_count = 0
+    if filenames:
+        imported_at = datetime.now(timezone.utc)
+        imported_count = state_collection.bulk_write([
+            UpdateOne({'_id': filename}, {'$setOnInsert': {'rows': None, 'at': imported_at}}, upsert=True)
+            for filename in filenames
+        ]).upserted_count
+    logging.info(f"Imported {imported_count} entries from {LEGACY_PROCESSED_FILES_LOG} into {state_collection.name}.")
+
+def get_processed_files(state_collection):
+    """Reads the set of already processed files from the state collection."""
+    return {doc['_id'] for doc in state_collection.find({}, {'_id': 1})}
+
+def mark_file_as_processed(state_collection, filename, rows):
+    """Records a filename as processed, together with how many records it produced."""
+    try:
+        state_collection.insert_one({'_id': filename, 'rows': rows, 'at': datetime.now(timezone.utc)})
+    except DuplicateKeyError:
+        logging.info(f"{filename} was already marked as processed.")
+
+def list_csv_files(directory):
+    """Lists the CSV files in a directory (hidden files excluded, as with glob)."""
+    with os.scandir(directory) as entries:
+        return [
+            entry.path for entry in entries
+            if entry.name.endswith('.csv') and not entry.name.startswith('.') and entry.is_file()
+        ]
 
 def process_csv_file(filepath, db_collection, source_filename):
     """Loads, cleans, validates, and inserts data from a single CSV file."""
     logging.info(f"Processing file: {filepath}")
     try:
-        df = pd.read_csv(filepath, delimiter=';')
+        df, unparseable_dates = read_csv_file(filepath)
         logging.info(f"Successfully loaded {len(df)} rows from {source_filename}")
     except Exception as e:
         logging.error(f"Error reading CSV file {filepath}: {e}")
         return 0
 
-    records_to_insert = []
-    for index, row in df.iterrows():
-        if pd.isna(row.get('Name')) or pd.isna(row.get('Date of Admission')):
-            logging.warning(f"Skipping row {index+2} in {source_filename} due to missing Name or Date of Admission.")
-            continue
-
-        record = {
-            "name": clean_name(row.get('Name')),
-            "age": int(row.get('Age')) if pd.notna(row.get('Age')) else None,
-            "gender": str(row.get('Gender')).strip().title() if pd.notna(row.get('Gender')) else None,
-            "blood_type": str(row.get('Blood Type')).strip() if pd.notna(row.get('Blood Type')) else None,
-            "medical_condition": str(row.get('Medical Condition')).strip().title() if pd.notna(row.get('Medical Condition')) else None,
-            "admission_date": parse_date(row.get('Date of Admission')),
-            "doctor_name": clean_name(row.get('Doctor')),
-            "hospital_name": str(row.get('Hospital')).strip() if pd.notna(row.get('Hospital')) else None,
-            "insurance_provider": str(row.get('Insurance Provider')).strip() if pd.notna(row.get('Insurance Provider')) else None,
-            "billing_amount": to_decimal128(row.get('Billing Amount')),
-            "room_number": str(row.get('Room Number')).strip() if pd.notna(row.get('Room Number')) else None,
-            "admission_type": str(row.get('Admission Type')).strip().title() if pd.notna(row.get('Admission Type')) else None,
-            "discharge_date": parse_date(row.get('Discharge Date')),
-            "medication": str(row.get('Medication')).strip().title() if pd.notna(row.get('Medication')) else None,
-            "test_results": str(row.get('Test Results')).strip().title() if pd.notna(row.get('Test Results')) else None,
-            "_source_filename": source_filename
-        }
-        records_to_insert.append(record)
+    expected_columns = [*TEXT_COLUMNS, *DATE_COLUMNS, 'Age', 'Billing Amount']
+    missing_columns = [column for column in expected_columns if column not in df.columns]
+    if missing_columns:
+        logging.error(f"CSV file {source_filename} is missing expected columns: {missing_columns}")
+        return 0
+
+    # Column-wise transforms: pandas runs these in C instead of building a Series per row.
+    records_df = pd.DataFrame(index=df.index)
+    for column, (field, title_case) in TEXT_COLUMNS.items():
+        clean_column = clean_category_column if column in LOW_CARDINALITY_COLUMNS else clean_text_column
+        records_df[field] = clean_column(df[column], title_case)
+    records_df['name_lc'] = records_df['name'].str.lower() # Lets substring name searches match case-insensitively on an index
+    # Fractional ages are truncated (as int() did) before the cast, which rejects non-integral floats
+    records_df['age'] = np.trunc(pd.to_numeric(df['Age'], errors='coerce')).astype('Int64')
+    for column, field in DATE_COLUMNS.items():
+        records_df[field] = df[column]
+    records_df['billing_amount'] = to_decimal128_column(df['Billing Amount'])
+    records_df['_source_filename'] = source_filename
+
+    records_df = records_df[RECORD_FIELDS]
+
+    # Problems are tallied per column and reported once per file rather than logged row by row.
+    # Rows with an unparseable admission date are skipped below rather than stored with null.
+    invalid_values = Counter({
+        column: int(mask.sum()) for column, mask in unparseable_dates.items() if column != 'Date of Admission'
+    })
+    invalid_values['Age'] = int(df['Age'].notna().sum() - records_df['age'].notna().sum())
+    invalid_values['Billing Amount'] = int(df['Billing Amount'].notna().sum() - records_df['billing_amount'].notna().sum())
+    invalid_values = +invalid_values # Drop the columns without problems
+    if invalid_values:
+        logging.warning(f"Stored null for {sum(invalid_values.values())} unparseable values in {source_filename}: {dict(invalid_values)}")
+
+    # Each skipped row is counted under one reason only: date problems are tallied over named rows.
+    named = records_df['name'].notna().to_numpy()
+    unparseable_admission_date = unparseable_dates['Date of Admission']
+    missing_admission_date = records_df['admission_date'].isna().to_numpy() & ~unparseable_admission_date
+    skipped = Counter(
+        missing_name=int((~named).sum()),
+        missing_admission_date=int((named & missing_admission_date).sum()),
+        unparseable_admission_date=int((named & unparseable_admission_date).sum()),
+    )
+    valid_df = records_df.dropna(subset=['name', 'admission_date'])
+    skipped_count = len(records_df) - len(valid_df)
+    if skipped_count:
+        logging.warning(f"Skipping {skipped_count} rows in {source_filename} due to a missing Name or a missing or unparseable Date of Admission: {dict(+skipped)}")
+
+    if valid_df.empty:
+        logging.info(f"No valid records to insert from {source_filename}.")
+        return 0
 
-    if records_to_insert:
+    # Documents are built and sent one batch at a time so only a single batch of dicts
+    # (and its BSON buffers) is alive at once, whatever the size of the CSV.
+    # Each record is upserted under an _id derived from its file and row number, so replaying
+    # a file after a partial failure never duplicates the records that already made it in.
+    build_record = get_record_builder(tuple(valid_df.columns))
+    upserted_count = 0
+    existing_count = 0
+    for start in range(0, len(valid_df), INSERT_BATCH_SIZE):
+        batch_df = valid_df.iloc[start:start + INSERT_BATCH_SIZE]
+        # BSON has no notion of pandas' missing-value markers, so they are stored as null.
+        batch_df = batch_df.astype(object).where(batch_df.notna(), None)
+        batch = [build_record(row) for row in batch_df.itertuples(index=False, name=None)]
+        # The index still holds each row's position in the CSV (invalid rows were only dropped)
+        ids = [record_id(source_filename, row_number) for row_number in batch_df.index]
+        requests = [
+            UpdateOne({'_id': _id}, {'$setOnInsert': record}, upsert=True)
+            for _id, record in zip(ids, batch)
+        ]
         try:
-            result = db_collection.insert_many(records_to_insert, ordered=False)
-            logging.info(f"Successfully inserted {len(result.inserted_ids)} records from {source_filename} into {db_collection.name}.")
-            return len(result.inserted_ids)
+            result = db_collection.bulk_write(requests, ordered=False, bypass_document_validation=True)
+            upserted_count += result.upserted_count
+            existing_count += result.matched_count
         except OperationFailure as e:
             logging.error(f"Error inserting records from {source_filename} into MongoDB: {e}")
             if e.details and 'writeErrors' in e.details:
                 for err in e.details['writeErrors']:
-                    logging.error(f"  Write error index {err['index']}: {err['errmsg']}")
+                    logging.error(f"  Write error index {start + err['index']}: {err['errmsg']}")
             return 0
-    else:
-        logging.info(f"No valid records to insert from {source_filename}.")
+
+    logging.info(f"Successfully inserted {upserted_count} records from {source_filename} into {db_collection.name} ({existing_count} were already present).")
+    return upserted_count + existing_count
+
+# MongoClient is not fork-safe, so every worker process opens its own in init_worker.
+_worker_client = None
+
+def init_worker():
+    """Connects the current worker process to MongoDB."""
+    global _worker_client
+    # Parallelism comes from the worker processes, so each one parses with a single Arrow
+    # thread rather than a pool as large as the host's CPU count.
+    pa.set_cpu_count(1)
+    _worker_client = get_mongo_client()
+
+def process_csv_file_wrapper(filepath, source_filename):
+    """Runs process_csv_file in a worker process, using that worker's own MongoClient."""
+    if _worker_client is None:
+        logging.error(f"Worker has no MongoDB connection; cannot process {source_filename}.")
         return 0
+    collection = _worker_client[MONGO_DB_NAME][MONGO_COLLECTION_NAME]
+    return process_csv_file(filepath, collection, source_filename)
+
+def process_new_files(new_files, db_collection):
+    """Processes (filepath, source_filename) pairs, yielding (source_filename, inserted_count) as each file finishes."""
+    # A single file gains nothing from a worker process, so it is processed here with the
+    # existing client (and Arrow's multithreaded reader) instead.
+    if len(new_files) == 1:
+        csv_file_path, source_filename = new_files[0]
+        logging.info("Processing 1 new file in-process.")
+        yield source_filename, process_csv_file(csv_file_path, db_collection, source_filename)
+        return
+
+    max_workers = min(ETL_MAX_WORKERS, len(new_files))
+    logging.info(f"Processing {len(new_files)} new files with {max_workers} worker processes.")
+    # Workers are spawned rather than forked so they don't inherit this process's
+    # MongoClient or any Arrow thread pool state.
+    with ProcessPoolExecutor(max_workers=max_workers, mp_context=multiprocessing.get_context('spawn'), initializer=init_worker) as executor:
+        futures = {
+            executor.submit(process_csv_file_wrapper, csv_file_path, source_filename): source_filename
+            for csv_file_path, source_filename in new_files
+        }
+        for future in as_completed(futures):
+            source_filename = futures[future]
+            try:
+                inserted_count = future.result()
+            except Exception as e:
+                logging.error(f"Worker failed while processing {source_filename}: {e}")
+                inserted_count = 0
+            yield source_filename, inserted_count
+
 # --- Main ETL Logic ---
-# ... (process_csv_file remains the same) ...
 
 if __name__ == "__main__":
     logging.info("Starting ETL Process...")
@@ -172,32 +401,39 @@ if __name__ == "__main__":
             db = client[MONGO_DB_NAME]
             collection = db[MONGO_COLLECTION_NAME]
             logging.info(f"Using database '{MONGO_DB_NAME}' and collection '{MONGO_COLLECTION_NAME}'.")
+            backfill_name_lc(collection)
+            ensure_indexes(collection)
 
-            processed_files = get_processed_files()
-            csv_files = glob.glob(os.path.join(DATA_DIR, "*.csv"))
+            # Filenames are the _id, so this read is answered from the _id index
+            state_collection = db[ETL_STATE_COLLECTION_NAME]
+            import_legacy_processed_files(state_collection)
+            processed_files = get_processed_files(state_collection)
+            csv_files = list_csv_files(DATA_DIR)
 
             if not csv_files:
                 logging.info("No CSV files found in the data directory.")
             else:
-                new_files_found = False
-                total_records_inserted_session = 0
+                new_files = []
                 for csv_file_path in csv_files:
                     source_filename = os.path.basename(csv_file_path)
                     if source_filename not in processed_files:
-                        new_files_found = True
                         logging.info(f"New file found: {source_filename}")
-                        inserted_count = process_csv_file(csv_file_path, collection, source_filename)
-                        if inserted_count > 0:
-                            mark_file_as_processed(source_filename)
-                            total_records_inserted_session += inserted_count
-                        else:
-                            logging.warning(f"No records were inserted from {source_filename}. It will be retried next time.")
+                        new_files.append((csv_file_path, source_filename))
                     else:
                         logging.info(f"Skipping already processed file: {source_filename}")
-                
-                if not new_files_found:
+
+                if not new_files:
                     logging.info("No new CSV files to process in this run.")
                 else:
+                    total_records_inserted_session = 0
+                    # Files are only marked as processed once the whole file has been written.
+                    for source_filename, inserted_count in process_new_files(new_files, collection):
+                        if inserted_count > 0:
+                            mark_file_as_processed(state_collection, source_filename, inserted_count)
+                            total_records_inserted_session += inserted_count
+                        else:
+                            logging.warning(f"No records were inserted from {source_filename}. It will be retried next time.")
+
                     logging.info(f"Total new records inserted in this session: {total_records_inserted_session}")
 
         except Exception as e:
@@ -1,36 +1,30 @@
 import os
+import atexit
+import re
+import logging
+import traceback
 from pymongo import MongoClient
 from pymongo.errors import ConnectionFailure
 from dotenv import load_dotenv
-from bson.son import SON
 from datetime import datetime
 
+logger = logging.getLogger(__name__)
+
 # --- Determine project root and .env path ---
 # This assumes query_script.py is in a subfolder (e.g., 'app') of the project root
 # If query_script.py is in the project root, change '..' to '.'
 try:
     SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
-    PROJECT_ROOT = os.path.abspath(os.path.join(SCRIPT_DIR, '..'))
-    DOTENV_PATH = os.path.join(PROJECT_ROOT, '.env')
 except NameError:
-    # __file__ is not defined if running in certain interactive environments
-    # Fallback for simple cases, assuming current working directory is project root
-    # and script is in a subdir like 'app'
-    print("DEBUG: __file__ not defined, attempting fallback for .env path")
-    DOTENV_PATH = os.path.join(os.getcwd(), '.env') # If script is run from root, and .env is in root
-    # If you run 'python app/query_script.py' from root, this would need to be '../.env'
-    # relative to the script. The above SCRIPT_DIR method is more robust.
-    # For your case: 'python app/query_script.py' from project root:
-    DOTENV_PATH = os.path.join(os.path.dirname(os.path.abspath("app/query_script.py")), '..', '.env')
-
-
-print(f"DEBUG: Script directory: {SCRIPT_DIR if '__file__' in locals() else 'N/A'}")
-print(f"DEBUG: Project root: {PROJECT_ROOT if '__file__' in locals() else 'N/A'}")
-print(f"DEBUG: Attempting to load .env from: {DOTENV_PATH}")
+    # __file__ is not defined if running in certain interactive environments.
+    # Fall back to assuming the current working directory is the project root
+    # (i.e. the script is run as 'python app/query_script.py').
+    SCRIPT_DIR = os.path.abspath('app')
+PROJECT_ROOT = os.path.abspath(os.path.join(SCRIPT_DIR, '..'))
+DOTENV_PATH = os.path.join(PROJECT_ROOT, '.env')
 
 # Load environment variables
-success = load_dotenv(DOTENV_PATH)
-print(f"DEBUG: load_dotenv success: {success}\n")
+DOTENV_LOADED = load_dotenv(DOTENV_PATH)
 
 # --- Get MongoDB Connection Details ---
 MONGO_USER = os.getenv('MONGO_INITDB_ROOT_USERNAME')
@@ -41,33 +35,60 @@ MONGO_PORT = int(os.getenv('MONGO_PORT', 27017))
 MONGO_DB_NAME = os.getenv('MONGO_DB_NAME')
 MONGO_COLLECTION_NAME = os.getenv('MONGO_COLLECTION_NAME') # Added for completeness
 
-# --- Print Debug Information ---
-print("--- DEBUG: Environment Variables ---")
-print(f"DEBUG: MONGO_USER='{MONGO_USER}'")
-# print(f"DEBUG: MONGO_PASS='{'*' * len(MONGO_PASS) if MONGO_PASS else None}'") # Mask password
-print(f"DEBUG: MONGO_PASS (length)='{len(MONGO_PASS) if MONGO_PASS else 0}'") # Safer: print length
-print(f"DEBUG: MONGO_HOST_SCRIPT='{MONGO_HOST_SCRIPT}'")
-print(f"DEBUG: MONGO_PORT={MONGO_PORT}")
-print(f"DEBUG: MONGO_DB_NAME='{MONGO_DB_NAME}'")
-print(f"DEBUG: MONGO_COLLECTION_NAME='{MONGO_COLLECTION_NAME}'")
-print("-----------------------------------\n")
+
+def log_configuration():
+    """Logs where the configuration came from (DEBUG level only; arguments are formatted lazily)."""
+    if not logger.isEnabledFor(logging.DEBUG):
+        return
+    logger.debug("Script directory: %s", SCRIPT_DIR)
+    logger.debug("Project root: %s", PROJECT_ROOT)
+    logger.debug("Loaded .env from %s: %s", DOTENV_PATH, DOTENV_LOADED)
+    logger.debug("MONGO_USER='%s'", MONGO_USER)
+    logger.debug("MONGO_PASS (length)='%d'", len(MONGO_PASS) if MONGO_PASS else 0) # Never log the password itself
+    logger.debug("MONGO_HOST_SCRIPT='%s'", MONGO_HOST_SCRIPT)
+    logger.debug("MONGO_PORT=%s", MONGO_PORT)
+    logger.debug("MONGO_DB_NAME='%s'", MONGO_DB_NAME)
+    logger.debug("MONGO_COLLECTION_NAME='%s'", MONGO_COLLECTION_NAME)
+
+
+# Shared by every run_queries() call so the handshake is paid once and the pool stays warm
+_client = None
+
+def _get_client():
+    """Returns the module's MongoClient, connecting on first use."""
+    global _client
+    if _client is None:
+        mongo_uri = f"mongodb://{MONGO_USER}:{MONGO_PASS}@{MONGO_HOST_SCRIPT}:{MONGO_PORT}/{MONGO_DB_NAME}?authSource=admin"
+        logger.debug("Connecting with URI: mongodb://%s:******@%s:%s/%s?authSource=admin", MONGO_USER, MONGO_HOST_SCRIPT, MONGO_PORT, MONGO_DB_NAME)
+        client = MongoClient(mongo_uri, serverSelectionTimeoutMS=5000) # Add timeout
+        try:
+            client.admin.command('ismaster') # Verify connection
+        except Exception:
+            client.close()
+            raise
+        _client = client
+        print(f"Successfully connected to MongoDB: {MONGO_HOST_SCRIPT}:{MONGO_PORT}, DB: {MONGO_DB_NAME}\n")
+    return _client
+
+def _close_client():
+    """Closes the shared MongoClient, if one was opened."""
+    global _client
+    if _client is not None:
+        _client.close()
+        _client = None
+        print("MongoDB connection closed.")
+
+atexit.register(_close_client)
 
 
 def run_queries():
+    log_configuration()
     if not all([MONGO_USER, MONGO_PASS, MONGO_HOST_SCRIPT, MONGO_PORT, MONGO_DB_NAME, MONGO_COLLECTION_NAME]):
         print("ERROR: One or more MongoDB connection variables are missing from .env or not loaded.")
         return
 
-    mongo_uri = f"mongodb://{MONGO_USER}:{MONGO_PASS}@{MONGO_HOST_SCRIPT}:{MONGO_PORT}/{MONGO_DB_NAME}?authSource=admin"
-    print(f"DEBUG: Connecting with URI: mongodb://{MONGO_USER}:******@{MONGO_HOST_SCRIPT}:{MONGO_PORT}/{MONGO_DB_NAME}?authSource=admin\n")
-
-    client = None  # Initialize client to None for finally block
     try:
-        client = MongoClient(mongo_uri, serverSelectionTimeoutMS=5000) # Add timeout
-        client.admin.command('ismaster') # Verify connection
-        db = client[MONGO_DB_NAME]
-        collection = db[MONGO_COLLECTION_NAME]
-        print(f"Successfully connected to MongoDB: {MONGO_HOST_SCRIPT}:{MONGO_PORT}, DB: {MONGO_DB_NAME}\n")
+        collection = _get_client()[MONGO_DB_NAME][MONGO_COLLECTION_NAME]
 
         # Query 1: How many patients are in the collection?
         print("--- Query 1: Total Patient Records ---")
@@ -80,11 +101,13 @@ def run_queries():
         patients_after_date_cursor = collection.find({
             "admission_date": {"$gt": query_date}
         }).limit(5) # Limit to 5 for brevity in script output
-        
+
         results_q2 = list(patients_after_date_cursor) # Convert cursor to list to check if empty
         if results_q2:
             for patient in results_q2:
                 print(f"  Name: {patient.get('name')}, Admission Date: {patient.get('admission_date')}, Condition: {patient.get('medical_condition')}")
+            # A separate count rather than a $facet: counting on the indexed field reads index keys
+            # only, while a $facet would fetch every matching document to feed its rows branch
             total_matching_q2 = collection.count_documents({"admission_date": {"$gt": query_date}})
             if total_matching_q2 > 5:
                 print(f"  ... and {total_matching_q2 - 5} more matching records.")
@@ -100,15 +123,19 @@ def run_queries():
 
         # Query 3b: How many patients have the name "Thomas"?
         print("--- Query 3b: Patients with 'Thomas' in Name ---")
-        thomas_count = collection.count_documents({"name": {"$regex": "Thomas", "$options": "i"}})
-        print(f"Number of patients with 'Thomas' in their name (case-insensitive): {thomas_count}\n")
+        # A case-sensitive regex on the lowercased, indexed name_lc field is answered from the
+        # index alone, unlike a case-insensitive ("$options": "i") regex on name
+        target_name = "Thomas" # Change if needed
+        name_pattern = re.compile(re.escape(target_name.lower()))
+        thomas_count = collection.count_documents({"name_lc": name_pattern})
+        print(f"Number of patients with '{target_name}' in their name (case-insensitive): {thomas_count}\n")
 
         # Query 3c: Count per each distinct Medical Condition
         print("--- Query 3c: Patient Count per Medical Condition ---")
+        # $sortByCount is the server's fused form of $group + $sort by count descending
         condition_counts = collection.aggregate([
-            {"$group": {"_id": "$medical_condition", "count": {"$sum": 1}}},
-            {"$sort": SON([("count", -1)])}
-        ])
+            {"$sortByCount": "$medical_condition"}
+        ], allowDiskUse=False)
         for condition in condition_counts:
             print(f"  {condition['_id']}: {condition['count']}")
         print("\n")
@@ -116,18 +143,17 @@ def run_queries():
         # Query 4: Frequency of usage for each Medication
         print("--- Query 4: Medication Frequency ---")
         medication_freq = collection.aggregate([
-            {"$group": {"_id": "$medication", "frequency": {"$sum": 1}}},
-            {"$sort": SON([("frequency", -1)])}
-        ])
+            {"$sortByCount": "$medication"}
+        ], allowDiskUse=False)
         for med in medication_freq:
-            print(f"  {med['_id']}: {med['frequency']}")
+            print(f"  {med['_id']}: {med['count']}")
         print("\n")
 
         # Query 5: Retrieve all patients currently taking "Lipitor"
         print("--- Query 5: Patients Taking 'Lipitor' (First 5) ---")
         target_medication = "Lipitor" # Change if needed
         lipitor_patients_cursor = collection.find({"medication": target_medication}).limit(5)
-        
+
         results_q5 = list(lipitor_patients_cursor)
         if results_q5:
             for patient in results_q5:
@@ -143,12 +169,9 @@ def run_queries():
         print(f"ERROR: Could not connect to MongoDB: {e}")
     except Exception as e:
         print(f"ERROR: An unexpected error occurred: {e}")
-        import traceback
         traceback.print_exc() # Print full traceback for unexpected errors
-    finally:
-        if client:
-            client.close()
-            print("MongoDB connection closed.")
 
 if __name__ == "__main__":
+    # Set LOG_LEVEL=DEBUG to see where the configuration was loaded from
+    logging.basicConfig(level=os.getenv('LOG_LEVEL', 'INFO').upper(), format='%(levelname)s: %(message)s')
     run_queries()
\ No newline at end of file